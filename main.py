@@ -1,72 +1,101 @@
 import json
+import logging
+import operator
+import os
 import re
+import sys
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
-from typing import List, Iterable, Optional, Set
+from typing import FrozenSet, List, Iterable, Optional, Set, Tuple
 
-import requests
-from bs4 import BeautifulSoup, Tag
+import requests_cache
+from lxml import etree
+from requests.adapters import HTTPAdapter
 from telegram.bot import Bot
 from telegram.ext import CommandHandler, Updater
 from telegram.parsemode import ParseMode
+from telegram.utils.request import Request
+from urllib3.util.retry import Retry
 
 
-def read_latest():
-    from datetime import datetime
-    fmt = "%H:%M:%S"
+def _has_class(name: str) -> str:
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
 
-    bands = []
-    with open('latest', 'r') as fd:
-        timestamp = datetime.strptime(time.strftime(fmt), fmt) - datetime.strptime(fd.readline().strip(), fmt)
-        if timestamp.total_seconds() > 3600:
-            return None
-        for line in fd.readlines():
-            try:
-                bands.append(Band.from_line(line))
-            except ValueError:
-                pass
 
-    return bands
+_BAND_NAME_XPATH = etree.XPath('.//span')
+_BAND_LINK_XPATH = etree.XPath('.//a[{}]/@href'.format(_has_class("BandBlock-link")))
 
+_BANDS_FILE_RE = re.compile(r"bands_(-?\d+)")
 
-def write_latest(bands):
-    timestamp = time.strftime("%H:%M:%S")
+# how often subscribers are checked for new bands, also the HTTP cache lifetime
+CHECK_INTERVAL = 3600
+# parsed lineup is kept in memory for a fraction of that, on top of the HTTP cache
+BANDS_MEMO_TTL = CHECK_INTERVAL // 12
+# (connect, read) timeout for scraping the lineup, bounds how long the lineup lock is held
+HTTP_TIMEOUT = (5, 30)
 
-    with open("latest", "w+") as fd:
-        fd.write(timestamp + "\n")
-        fd.write("\n".join([str(band) for band in bands]))
+# threads running command handlers and sending scheduled announcements
+HANDLER_WORKERS = 8
+SEND_WORKERS = 8
+# PTB wants workers + 4 connections (polling, job queue, ...), plus one per sender thread
+CON_POOL_SIZE = HANDLER_WORKERS + 4 + SEND_WORKERS
 
 
-@dataclass(frozen=True)
-class Band:
-    name: str
-    url: str
+# Blocks callers so that at most `rate` calls happen within any `per` seconds
+class RateLimiter:
+    def __init__(self, rate: int, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self._calls = deque()
+        self._lock = threading.Lock()
 
-    @classmethod
-    def from_soup(cls, div: Tag):
-        span = div.find('span')
-        link = div.find('a', {'class': 'BandBlock-link'})
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._calls and now - self._calls[0] >= self.per:
+                self._calls.popleft()
 
-        if not link or not span:
-            raise ValueError("Couldn't find name/url tag in band div")
+            if len(self._calls) >= self.rate:
+                time.sleep(self.per - (now - self._calls[0]))
+                self._calls.popleft()
 
-        name = span.text.strip()
-        url = "https://rock-am-ring.de{}".format(link.get('href'))
+            self._calls.append(time.monotonic())
+
+
+# Telegram allows ~30 messages per second across all chats
+send_limiter = RateLimiter(25)
 
-        return cls(name, url)
+
+@dataclass(frozen=True)
+class Band:
+    name: str
+    url: str
+    markdown: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # share storage for names/urls repeated across every user's band set
+        object.__setattr__(self, 'name', sys.intern(self.name))
+        object.__setattr__(self, 'url', sys.intern(self.url))
+        # rendered once here instead of once per recipient
+        if self.url:
+            object.__setattr__(self, 'markdown', "[{}]({})".format(self.name, self.url))
+        else:
+            object.__setattr__(self, 'markdown', self.name)
 
     @classmethod
     def from_line(cls, line: str):
-        name, url = re.findall(r"\[(.*?)]\((.*?)\)", line.strip())[0]
+        line = line.strip()
+        name, separator, url = line[1:-1].partition("](")
+        if not separator or not line.startswith("[") or not line.endswith(")"):
+            raise ValueError("Couldn't parse band line: {}".format(line))
 
         return cls(name, url)
 
     def __str__(self):
-        if not self.url:
-            return self.name
-
-        return "[{}]({})".format(self.name, self.url)
+        return self.markdown
 
 
 @dataclass(frozen=True)
@@ -81,23 +110,28 @@ class Message:
 
         max_length = 4096
         messages = []
-        current = ""
+        buf = []
+        buflen = 0
 
         # noinspection PyTypeChecker
         # can't be None
-        for item in content:
-            if len(current) + len(item) > max_length:
-                messages.append(current)
-                current = ""
-
-            current = separator.join([current, item])
-        messages.append(current)
+        for item in content or self.content:
+            item_length = len(item) + len(separator)
+            if buf and buflen + item_length > max_length:
+                messages.append(separator.join(buf))
+                buf = []
+                buflen = 0
+
+            buf.append(item)
+            buflen += item_length
+        if buf:
+            messages.append(separator.join(buf))
 
         return messages
 
     def send_bands(self, bands: Iterable[Band]):
         if bands:
-            self.send([str(band) for band in bands], parse_mode=ParseMode.MARKDOWN)
+            self.send([band.markdown for band in bands], parse_mode=ParseMode.MARKDOWN)
         else:
             self.send(["Keine neuen Announcements."])
 
@@ -109,6 +143,7 @@ class Message:
 
         first = True
         for message in messages:
+            send_limiter.wait()
             self.bot.send_message(chat_id=self.uid,
                                   text=message,
                                   parse_mode=parse_mode,
@@ -122,50 +157,102 @@ class Message:
 class User:
     id: int
     bands: Set = field(default_factory=set)
+    _old: Optional[FrozenSet[Band]] = field(default=None, init=False, repr=False, compare=False)
+    # handlers run on the dispatcher's worker pool next to the scheduler thread
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False, compare=False)
+
+    def write_bands(self, bands: Iterable[Band], band_set: Optional[FrozenSet[Band]] = None):
+        if band_set is None:
+            band_set = frozenset(bands)
+
+        with self._lock:
+            self.bands = bands
+            if band_set == self._old:
+                return
+
+            path = "data/bands_{}".format(self.id)
+            with open(path + ".tmp", "w") as fd:
+                fd.write("\n".join([band.markdown for band in bands]))
+            os.replace(path + ".tmp", path)
+            self._old = band_set
+
+    def get_old_bands(self) -> FrozenSet[Band]:
+        if self._old is None:
+            old_bands = []
+            try:
+                with open("data/bands_{}".format(self.id), "r") as old_bands_fd:
+                    for line in old_bands_fd.readlines():
+                        try:
+                            old_bands.append(Band.from_line(line))
+                        except ValueError:
+                            pass
+            except OSError:
+                pass
+            self._old = frozenset(old_bands)
+
+        return self._old
 
-    def write_bands(self, bands: Iterable[Band]):
+    def get_new_bands(self, bands: Iterable[Band], band_set: FrozenSet[Band]) -> List[Band]:
+        old_bands = self.get_old_bands()
         self.bands = bands
-        with open("data/bands_{}".format(self.id), "w+") as fd:
-            fd.write("\n".join([str(band) for band in bands]))
 
-    def get_old_bands(self) -> Iterable[Band]:
-        try:
-            with open("data/bands_{}".format(self.id), "r") as old_bands_fd:
-                return [Band.from_line(line) for line in old_bands_fd.readlines()]
-        except OSError:
+        if band_set <= old_bands:
             return []
 
-    def get_new_bands(self, bands: Iterable[Band]) -> Iterable[Band]:
-        old_bands = set(self.get_old_bands())
-        self.bands = bands
+        # keeps the (sorted) order of `bands`
+        return [band for band in bands if band not in old_bands]
+
+    def update_bands(self, bands: Iterable[Band], band_set: FrozenSet[Band]) -> List[Band]:
+        with self._lock:
+            new_bands = self.get_new_bands(bands, band_set)
+            self.write_bands(bands, band_set)
 
-        return set(bands).difference(old_bands)
+        return new_bands
 
 
 # noinspection PyShadowingNames
-class Users(list):
+class Users(dict):
     def __init__(self):
         super().__init__()
 
-        import os
+        if not os.path.isdir("data"):
+            return
 
-        for file in os.listdir("."):
-            match = re.findall(r"data/bands_(-?\d+)", file)
-            if match:
-                uid = int(match[0])
-                self.append(User(uid))
+        with os.scandir("data") as entries:
+            for entry in entries:
+                match = _BANDS_FILE_RE.fullmatch(entry.name)
+                if match and entry.is_file():
+                    uid = int(match.group(1))
+                    self[uid] = User(uid)
 
-    def get(self, uid: int):
-        users = [user for user in self if user.id == uid]
-        if users:
-            user = users[0]
-        else:
-            user = User(uid)
-            self.append(user)
+    def get(self, uid: int) -> User:
+        user = dict.get(self, uid)
+        if user is None:
+            user = self.setdefault(uid, User(uid))
 
         return user
 
 
+# Emits a Band for every BandBlock div closed since the last call, then drops it and
+# its earlier siblings from the tree so it doesn't grow with the number of bands
+def _read_band_events(parser: etree.HTMLPullParser) -> Iterable[Band]:
+    for _, div in parser.read_events():
+        if "BandBlock" not in (div.get("class") or "").split():
+            continue
+
+        names = _BAND_NAME_XPATH(div)
+        links = _BAND_LINK_XPATH(div)
+        if names and links:
+            # collapse <br>s and other whitespace so the name fits on one stored line
+            name = " ".join("".join(names[0].itertext()).split())
+            url = "https://rock-am-ring.de{}".format(links[0])
+            yield Band(name, url)
+
+        div.clear()
+        while div.getprevious() is not None:
+            del div.getparent()[0]
+
+
 # noinspection PyShadowingNames
 class RockAmRing(Bot):
     def __init__(self, token: str):
@@ -173,54 +260,61 @@ class RockAmRing(Bot):
             raise ValueError("`token` must have a valid value ({} given).".format(token))
 
         self.users = Users()
-        super().__init__(token)
+        self._cache: Optional[Tuple[float, List[Band], FrozenSet[Band]]] = None
+        self._cache_lock = threading.Lock()
 
-    @staticmethod
-    def get_band_items() -> Iterable[Band]:
-        try:
-            latest = read_latest()
-        except OSError:
-            latest = None
-        if latest:
-            return latest
-
-        content = requests.get("http://rock-am-ring.de/lineup").content
-        soup = BeautifulSoup(content, 'html.parser')
-        band_divs = soup.find_all("div", {"class": "BandBlock"})
-        bands = []
+        self.http = requests_cache.CachedSession("data/http_cache",
+                                                 backend="sqlite",
+                                                 expire_after=CHECK_INTERVAL,
+                                                 cache_control=True,
+                                                 stale_if_error=86400)
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        self.http.mount("http://", HTTPAdapter(max_retries=retries))
+        self.http.mount("https://", HTTPAdapter(max_retries=retries))
 
-        for div in band_divs:
-            try:
-                bands.append(Band.from_soup(div))
-            except ValueError:
-                pass
+        super().__init__(token, request=Request(con_pool_size=CON_POOL_SIZE))
 
-        write_latest(bands)
+    def get_band_items(self, refresh: bool = False) -> Tuple[List[Band], FrozenSet[Band]]:
+        with self._cache_lock:
+            if not refresh and self._cache and time.monotonic() - self._cache[0] < BANDS_MEMO_TTL:
+                return self._cache[1], self._cache[2]
 
-        return bands
+            bands = self._fetch_band_items()
+            band_set = frozenset(bands)
+            self._cache = (time.monotonic(), bands, band_set)
+
+            return bands, band_set
+
+    def _fetch_band_items(self) -> List[Band]:
+        parser = etree.HTMLPullParser(events=("end",), tag="div")
+        bands = []
+
+        # the HTTP cache holds the whole body anyway, but feeding it in slices and
+        # draining finished bands in between keeps the parsed tree small
+        content = self.http.get("http://rock-am-ring.de/lineup", timeout=HTTP_TIMEOUT).content
+        for i in range(0, len(content), 16384):
+            parser.feed(content[i:i + 16384])
+            bands.extend(_read_band_events(parser))
+        parser.close()
+        bands.extend(_read_band_events(parser))
+
+        return sorted(bands, key=operator.attrgetter('name'))
 
     def send_bands(self, uid: int, bands: Iterable[Band]):
-        bands = list(bands)
-        bands.sort(key=lambda x: x.name)
         Message(uid, self).send_bands(bands)
 
     def get_bands(self, uid: int) -> Iterable[Band]:
-        bands = self.get_band_items()
+        bands, band_set = self.get_band_items()
 
         user = self.users.get(uid)
-        user.write_bands(bands)
+        user.write_bands(bands, band_set)
 
         return bands
 
     def get_new(self, uid: int):
-        bands = self.get_band_items()
-
-        new_bands = self.users.get(uid).get_new_bands(bands)
+        bands, band_set = self.get_band_items()
 
-        user = self.users.get(uid)
-        user.write_bands(bands)
-
-        return new_bands
+        return self.users.get(uid).update_bands(bands, band_set)
 
     def bands(self, update):
         uid = update.message.chat_id
@@ -240,33 +334,48 @@ class RockAmRing(Bot):
 
 # noinspection PyShadowingNames
 def sched_new(rar: RockAmRing):
-    import os
-    for file in os.listdir("."):
+    bands, band_set = rar.get_band_items(refresh=True)
+
+    new_by_uid = {}
+    for user in list(rar.users.values()):
         try:
-            uid = re.findall(r"data/bands_(.*)", file)[0]
-            if uid:
-                uid = int(uid)
-                bands = rar.get_new(uid)
-                if bands:
-                    rar.send_bands(uid, bands)
-        except IndexError:
-            pass
+            new_bands = user.update_bands(bands, band_set)
+        except Exception:
+            logging.exception("Checking new bands for user {} failed".format(user.id))
+            continue
+
+        if new_bands:
+            new_by_uid[user.id] = new_bands
+
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS) as executor:
+        futures = [executor.submit(rar.send_bands, uid, new_bands) for uid, new_bands in new_by_uid.items()]
+        for future in as_completed(futures):
+            error = future.exception()
+            if error:
+                logging.error("Sending new bands failed", exc_info=error)
 
-    schedule(rar)
+
+# noinspection PyShadowingNames
+def _sched_loop(rar: RockAmRing, interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            sched_new(rar)
+        except Exception:
+            logging.exception("Scheduled check for new bands failed")
 
 
 # noinspection PyShadowingNames
-def schedule(rar, time=3600):
-    t = threading.Timer(time, sched_new, args=[rar])
-    t.daemon = True
+def schedule(rar, interval=CHECK_INTERVAL):
+    t = threading.Thread(target=_sched_loop, args=[rar, interval], daemon=True)
     t.start()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     try:
         with open("secret.json", "r") as f:
             token = json.load(f)['token']
-        import os
 
         token = os.getenv("TELEGRAM_BOT_TOKEN", token)
 
@@ -274,14 +383,14 @@ if __name__ == "__main__":
             os.mkdir("data")
 
         rar = RockAmRing(token)
-        updater = Updater(bot=rar)
+        updater = Updater(bot=rar, use_context=False, workers=HANDLER_WORKERS)
         dispatcher = updater.dispatcher
 
         schedule(rar)
 
-        dispatcher.add_handler(CommandHandler("bands", lambda b, u: b.bands(u)))
-        dispatcher.add_handler(CommandHandler("neu", lambda b, u: b.new_bands(u)))
-        dispatcher.add_handler(CommandHandler("start", lambda b, u: b.start()))
+        dispatcher.add_handler(CommandHandler("bands", lambda b, u: b.bands(u), run_async=True))
+        dispatcher.add_handler(CommandHandler("neu", lambda b, u: b.new_bands(u), run_async=True))
+        dispatcher.add_handler(CommandHandler("start", lambda b, u: b.start(u), run_async=True))
         dispatcher.add_handler(CommandHandler("status",
                                               lambda b, u: b.send_message(chat_id=u.message.chat_id,
                                                                           text="[{}] Ok".format(u.message.chat_id))))